@@ -1,22 +1,45 @@
 use crate::logic::board::OpResult;
 use crate::logic::room::{Room, RoomState};
 use crate::utils::generate_room_id;
-use axum::extract::ws::{Message, WebSocket};
+use axum::extract::ws::{CloseFrame, Message, WebSocket};
 use futures::stream::StreamExt;
 use futures_util::{sink::SinkExt, stream::SplitSink};
 use lazy_static::lazy_static;
 use log::{error, info, warn};
 use serde::{Deserialize, Serialize};
+use std::collections::hash_map::DefaultHasher;
 use std::collections::HashMap;
 use std::fmt;
+use std::hash::{Hash, Hasher};
+use std::sync::atomic::{AtomicUsize, Ordering};
+use std::sync::Arc;
+use std::time::Duration;
+use tokio::sync::broadcast::error::RecvError;
 use tokio::sync::{broadcast, oneshot, Mutex};
+use tokio::time::{interval_at, Instant};
+
+// 每个房间广播通道的容量，慢速客户端最多可以落后这么多条消息
+const BROADCAST_CAPACITY: usize = 1024;
+// 房间表的分片数（2 的幂），不同分片的房间各自加锁，互不阻塞
+const ROOM_SHARDS: usize = 64;
+// 服务端发送 Ping 的间隔，连续这么多个 Ping 没有收到 Pong 就以 1011 关闭连接
+const PING_INTERVAL: Duration = Duration::from_secs(20);
+const MAX_MISSED_PINGS: usize = 3;
 
 lazy_static! {
     // 根据房间id，维护所有的房间
-    static ref ROOMS: Mutex<HashMap<String, Room>> = Mutex::new(HashMap::new());
+    static ref ROOMS: Vec<Mutex<HashMap<String, Room>>> =
+        (0..ROOM_SHARDS).map(|_| Mutex::new(HashMap::new())).collect();
     // 根据房间id，维护所有的房间的消息广播器，用于在一个房间内广播玩家加入，玩家离开，游戏开始，玩家操作结果 信息
-    static ref ROOMS_SENDERS: Mutex<HashMap<String, broadcast::Sender<ResponseModel>>> =
-        Mutex::new(HashMap::new());
+    static ref ROOMS_SENDERS: Vec<Mutex<HashMap<String, broadcast::Sender<ResponseModel>>>> =
+        (0..ROOM_SHARDS).map(|_| Mutex::new(HashMap::new())).collect();
+}
+
+// 房间所在的分片，ROOMS 与 ROOMS_SENDERS 使用同一个分片下标
+fn shard(room_id: &str) -> usize {
+    let mut hasher = DefaultHasher::new();
+    room_id.hash(&mut hasher);
+    (hasher.finish() as usize) & (ROOM_SHARDS - 1)
 }
 
 // 玩家
@@ -94,70 +117,126 @@ enum ResponseModel {
     },
 }
 
+// 消息编码：文本帧使用 JSON，二进制帧使用 MessagePack，服务端按客户端请求的格式回复
+#[derive(Debug, Clone, Copy, PartialEq, Eq)]
+enum Codec {
+    Json,
+    MsgPack,
+}
+
+impl Codec {
+    fn decode(self, data: &[u8]) -> Result<RequestModel, String> {
+        match self {
+            Codec::Json => serde_json::from_slice(data).map_err(|e| e.to_string()),
+            Codec::MsgPack => rmp_serde::from_slice(data).map_err(|e| e.to_string()),
+        }
+    }
+
+    fn encode<T: Serialize>(self, value: &T) -> Message {
+        match self {
+            Codec::Json => Message::Text(serde_json::to_string(value).unwrap()),
+            Codec::MsgPack => Message::Binary(rmp_serde::to_vec_named(value).unwrap()),
+        }
+    }
+}
+
 type WsSender = SplitSink<WebSocket, Message>;
 type BrRecver = broadcast::Receiver<ResponseModel>;
 
+// 连接存活检测，由 handle_socket 创建并交给广播任务
+struct Liveness {
+    // 尚未收到 Pong 的 Ping 数，接收循环收到 Pong 时清零
+    missed_pings: Arc<AtomicUsize>,
+    // 广播任务退出时通知 handle_socket 让玩家离开房间
+    done: oneshot::Sender<()>,
+}
+
 pub async fn handle_socket(socket: WebSocket) {
     let (ws_sender, mut ws_recver) = socket.split();
     let mut ws_sr: Option<SplitSink<WebSocket, Message>> = Some(ws_sender);
     let mut cur_room_id = None;
     let mut cur_player: Option<Player> = None;
-    while let Some(msg) = ws_recver.next().await {
-        match msg {
+    let missed_pings = Arc::new(AtomicUsize::new(0));
+    let (done_tx, mut done_rx) = oneshot::channel();
+    let mut done_tx = Some(done_tx);
+    loop {
+        let msg = tokio::select! {
+            msg = ws_recver.next() => match msg {
+                Some(msg) => msg,
+                None => break,
+            },
+            // 广播任务已退出（发送失败、消费过慢或 Ping 超时），连接不再可用
+            _ = &mut done_rx => {
+                info!("{cur_room_id:?} | Info | Subscriber closed, {cur_player:?}");
+                leave_room(&cur_room_id, &cur_player).await;
+                break;
+            }
+        };
+        let (codec, data) = match msg {
             Ok(Message::Close(_)) => {
                 info!("{cur_room_id:?} | Request | Close, {cur_player:?}");
                 leave_room(&cur_room_id, &cur_player).await;
                 break;
             }
-            Ok(message) => {
-                let message = message.into_text().unwrap();
-                let request_model: Result<RequestModel, _> = serde_json::from_str(&message);
-                match request_model {
-                    Ok(RequestModel::InitRoom { player, config }) => {
-                        if let Some(ws_sender) = ws_sr.take() {
-                            info!("None | Request | InitRoom, {player:?}, {config:?}");
-                            let room_id = init_room(&config).await;
-                            if join_room(ws_sender, &room_id, &player).await {
-                                cur_player = Some(player);
-                                cur_room_id = Some(room_id);
-                            } else {
-                                break;
-                            }
-                        }
-                    }
-                    Ok(RequestModel::JoinRoom { room_id, player }) => {
-                        if let Some(ws_sender) = ws_sr.take() {
-                            info!("{room_id} | Request | JoinRoom, {player:?}");
-                            if join_room(ws_sender, &room_id, &player).await {
-                                cur_player = Some(player);
-                                cur_room_id = Some(room_id);
-                            } else {
-                                break;
-                            }
-                        }
+            Ok(Message::Text(text)) => (Codec::Json, text.into_bytes()),
+            Ok(Message::Binary(data)) => (Codec::MsgPack, data),
+            Ok(Message::Pong(_)) => {
+                missed_pings.store(0, Ordering::Relaxed);
+                continue;
+            }
+            Ok(_) => continue,
+            Err(e) => {
+                error!("{cur_room_id:?} | Error | Connection exception:{e}");
+                if let Some(mut ws_sender) = ws_sr.take() {
+                    ws_sender.close().await.unwrap();
+                }
+                leave_room(&cur_room_id, &cur_player).await;
+                break;
+            }
+        };
+        match codec.decode(&data) {
+            Ok(RequestModel::InitRoom { player, config }) => {
+                if let (Some(ws_sender), Some(done)) = (ws_sr.take(), done_tx.take()) {
+                    info!("None | Request | InitRoom, {player:?}, {config:?}");
+                    let room_id = init_room(&config).await;
+                    let liveness = Liveness {
+                        missed_pings: missed_pings.clone(),
+                        done,
+                    };
+                    if join_room(ws_sender, codec, liveness, &room_id, &player).await {
+                        cur_player = Some(player);
+                        cur_room_id = Some(room_id);
+                    } else {
+                        break;
                     }
-                    Ok(RequestModel::GAction { action }) => match (&cur_room_id, &cur_player) {
-                        (Some(room_id), Some(player)) => {
-                            info!("{room_id} | Request | GAction, {}, {action:?}", player.id);
-                            handle_action(room_id, player, &action).await;
-                        }
-                        _ => {}
-                    },
-                    Err(e) => {
-                        warn!("{cur_room_id:?} | Warn | Parsing message:{e}");
-                        if let Some(mut ws_sender) = ws_sr.take() {
-                            let resp_body = serde_json::to_string(&e.to_string()).unwrap();
-                            ws_sender.send(Message::Text(resp_body)).await.unwrap();
-                            ws_sender.close().await.unwrap();
-                        }
-                        leave_room(&cur_room_id, &cur_player).await;
+                }
+            }
+            Ok(RequestModel::JoinRoom { room_id, player }) => {
+                if let (Some(ws_sender), Some(done)) = (ws_sr.take(), done_tx.take()) {
+                    info!("{room_id} | Request | JoinRoom, {player:?}");
+                    let liveness = Liveness {
+                        missed_pings: missed_pings.clone(),
+                        done,
+                    };
+                    if join_room(ws_sender, codec, liveness, &room_id, &player).await {
+                        cur_player = Some(player);
+                        cur_room_id = Some(room_id);
+                    } else {
                         break;
                     }
                 }
             }
+            Ok(RequestModel::GAction { action }) => match (&cur_room_id, &cur_player) {
+                (Some(room_id), Some(player)) => {
+                    info!("{room_id} | Request | GAction, {}, {action:?}", player.id);
+                    handle_action(room_id, player, &action).await;
+                }
+                _ => {}
+            },
             Err(e) => {
-                error!("{cur_room_id:?} | Error | Connection exception:{e}");
+                warn!("{cur_room_id:?} | Warn | Parsing message:{e}");
                 if let Some(mut ws_sender) = ws_sr.take() {
+                    ws_sender.send(codec.encode(&e)).await.unwrap();
                     ws_sender.close().await.unwrap();
                 }
                 leave_room(&cur_room_id, &cur_player).await;
@@ -167,18 +246,59 @@ pub async fn handle_socket(socket: WebSocket) {
     }
 }
 
-async fn broadcast_action(room_id: String, mut br_recver: BrRecver, mut ws_sender: WsSender) {
-    while let Ok(response) = br_recver.recv().await {
-        let resp_body = serde_json::to_string(&response).unwrap();
-        let _ = ws_sender.send(Message::Text(resp_body)).await;
+async fn broadcast_action(
+    room_id: String,
+    codec: Codec,
+    liveness: Liveness,
+    mut br_recver: BrRecver,
+    mut ws_sender: WsSender,
+) {
+    let mut ping_timer = interval_at(Instant::now() + PING_INTERVAL, PING_INTERVAL);
+    loop {
+        let response = tokio::select! {
+            response = br_recver.recv() => response,
+            _ = ping_timer.tick() => {
+                if liveness.missed_pings.fetch_add(1, Ordering::Relaxed) >= MAX_MISSED_PINGS {
+                    warn!("{room_id:?} | Warn | Ping timeout, disconnect");
+                    let _ = ws_sender
+                        .send(Message::Close(Some(CloseFrame {
+                            code: 1011,
+                            reason: "ping timeout".into(),
+                        })))
+                        .await;
+                    break;
+                }
+                if let Err(e) = ws_sender.send(Message::Ping(vec![])).await {
+                    warn!("{room_id:?} | Warn | Ping failed, drop subscriber:{e}");
+                    break;
+                }
+                continue;
+            }
+        };
+        match response {
+            Ok(response) => {
+                if let Err(e) = ws_sender.send(codec.encode(&response)).await {
+                    warn!("{room_id:?} | Warn | Send failed, drop subscriber:{e}");
+                    break;
+                }
+            }
+            // The channel already dropped the oldest messages; the client can no
+            // longer rebuild the board from the op results, so disconnect it.
+            Err(RecvError::Lagged(n)) => {
+                warn!("{room_id:?} | Warn | Slow consumer lagged {n} messages, disconnect");
+                break;
+            }
+            Err(RecvError::Closed) => break,
+        }
     }
     let _ = ws_sender.close().await;
+    let _ = liveness.done.send(());
     info!("{room_id:?} | Info | release resource");
 }
 
 async fn handle_action(room_id: &String, player: &Player, action: &GAction) {
-    let mut rooms = ROOMS.lock().await;
-    let mut rooms_senders = ROOMS_SENDERS.lock().await;
+    let mut rooms = ROOMS[shard(room_id)].lock().await;
+    let mut rooms_senders = ROOMS_SENDERS[shard(room_id)].lock().await;
 
     if let Some(room) = rooms.get_mut(room_id) {
         let op_res = room.game_state.op(action.x, action.y, action.f);
@@ -193,24 +313,29 @@ async fn handle_action(room_id: &String, player: &Player, action: &GAction) {
 async fn init_room(config: &Gconfig) -> String {
     let room_id: String = generate_room_id();
     let room = Room::new(room_id.clone(), config.clone());
-    let mut rooms = ROOMS.lock().await;
+    let mut rooms = ROOMS[shard(&room_id)].lock().await;
     rooms.insert(room_id.clone(), room);
 
-    let (br_sender, _) = broadcast::channel(config.n_player);
-    let mut rooms_senders = ROOMS_SENDERS.lock().await;
+    let (br_sender, _) = broadcast::channel(BROADCAST_CAPACITY);
+    let mut rooms_senders = ROOMS_SENDERS[shard(&room_id)].lock().await;
     rooms_senders.insert(room_id.to_string(), br_sender);
     room_id
 }
 
-async fn join_room(mut ws_sender: WsSender, room_id: &String, player: &Player) -> bool {
-    let mut rooms = ROOMS.lock().await;
+async fn join_room(
+    mut ws_sender: WsSender,
+    codec: Codec,
+    liveness: Liveness,
+    room_id: &String,
+    player: &Player,
+) -> bool {
+    let mut rooms = ROOMS[shard(room_id)].lock().await;
     if let Some(room) = rooms.get_mut(room_id) {
         if RoomState::Gameing == room.room_state {
             let err_mes = format!("Room {} is already full,{:?}", room_id, player);
             info!("{room_id} | Response | InvalidRequest, {err_mes:?}");
             let error_mes = ResponseModel::InvalidRequest { error: err_mes };
-            let error_mes = serde_json::to_string(&error_mes).unwrap();
-            ws_sender.send(Message::Text(error_mes)).await.unwrap();
+            ws_sender.send(codec.encode(&error_mes)).await.unwrap();
             ws_sender.close().await.unwrap();
             return false;
         }
@@ -219,13 +344,12 @@ async fn join_room(mut ws_sender: WsSender, room_id: &String, player: &Player) -
             players: room.players.clone(),
             room_id: room_id.clone(),
         };
-        let response = serde_json::to_string(&response).unwrap();
         info!("{room_id} | Response | JoinSuccess, {player:?}");
-        ws_sender.send(Message::Text(response)).await.unwrap();
+        ws_sender.send(codec.encode(&response)).await.unwrap();
 
         // Broadcast to players in the current room with new players joining
         info!("{room_id} | Broadcast | PlayerJoin, {player:?}");
-        let mut rooms_senders = ROOMS_SENDERS.lock().await;
+        let mut rooms_senders = ROOMS_SENDERS[shard(room_id)].lock().await;
         let br_sender = rooms_senders.get_mut(room_id).unwrap();
         let _ = br_sender.send(ResponseModel::PlayerJoin {
             player: player.clone(),
@@ -238,7 +362,7 @@ async fn join_room(mut ws_sender: WsSender, room_id: &String, player: &Player) -
         let c_room_id = room_id.clone();
         tokio::spawn(async move {
             let _ = tx.send(1);
-            broadcast_action(c_room_id, br_recver, ws_sender).await
+            broadcast_action(c_room_id, codec, liveness, br_recver, ws_sender).await
         });
         if rx.await.is_ok() && room_state == RoomState::Gameing {
             info!("{room_id} | Broadcast | GameStart | {0:?}", room.gconfig);
@@ -251,8 +375,7 @@ async fn join_room(mut ws_sender: WsSender, room_id: &String, player: &Player) -
         let err_mes = format!("Room {} does not exist,{:?}", room_id, player);
         info!("{room_id} | Response | InvalidRequest, {err_mes:?}");
         let error_mes = ResponseModel::InvalidRequest { error: err_mes };
-        let error_mes = serde_json::to_string(&error_mes).unwrap();
-        ws_sender.send(Message::Text(error_mes)).await.unwrap();
+        ws_sender.send(codec.encode(&error_mes)).await.unwrap();
         ws_sender.close().await.unwrap();
         return false;
     }
@@ -262,9 +385,9 @@ async fn join_room(mut ws_sender: WsSender, room_id: &String, player: &Player) -
 async fn leave_room(room_id: &Option<String>, player: &Option<Player>) {
     if let Some(ref room_id) = room_id {
         let player_id = player.as_ref().unwrap().id.clone();
-        let mut rooms = ROOMS.lock().await;
+        let mut rooms = ROOMS[shard(room_id)].lock().await;
         if let Some(room) = rooms.get_mut(room_id) {
-            let mut rooms_senders = ROOMS_SENDERS.lock().await;
+            let mut rooms_senders = ROOMS_SENDERS[shard(room_id)].lock().await;
             match room.remove_player(&player_id) {
                 RoomState::Logout => {
                     info!("{room_id} | XXXXXX | Last PlayerLeave, Drop, {player_id}");
@@ -283,3 +406,106 @@ async fn leave_room(room_id: &Option<String>, player: &Option<Player>) {
         }
     }
 }
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use serde_json::{json, Value};
+
+    fn init_room_value() -> Value {
+        json!({
+            "type": "InitRoom",
+            "player": {"id": "id1", "name": "name1", "icon": "icon1"},
+            "config": {"cols": 10, "rows": 10, "mines": 16},
+        })
+    }
+
+    fn assert_init_room(request: Result<RequestModel, String>) {
+        match request {
+            Ok(RequestModel::InitRoom { player, config }) => {
+                assert_eq!(player.id, "id1");
+                assert_eq!(player.name, "name1");
+                assert_eq!(player.icon, "icon1");
+                assert_eq!((config.cols, config.rows, config.mines), (10, 10, 16));
+                assert_eq!(config.n_player, default_n_player());
+            }
+            other => panic!("unexpected request: {other:?}"),
+        }
+    }
+
+    #[test]
+    fn decode_json_init_room() {
+        let data = serde_json::to_vec(&init_room_value()).unwrap();
+        assert_init_room(Codec::Json.decode(&data));
+    }
+
+    #[test]
+    fn decode_msgpack_init_room() {
+        // Python msgpack.packb 对 init_room_value() 同构 dict 的输出（old_test_conn.py 的发送方式）
+        let data: &[u8] = &[
+            0x83, 0xa4, 0x74, 0x79, 0x70, 0x65, 0xa8, 0x49, 0x6e, 0x69, 0x74, 0x52, 0x6f, 0x6f,
+            0x6d, 0xa6, 0x70, 0x6c, 0x61, 0x79, 0x65, 0x72, 0x83, 0xa2, 0x69, 0x64, 0xa3, 0x69,
+            0x64, 0x31, 0xa4, 0x6e, 0x61, 0x6d, 0x65, 0xa5, 0x6e, 0x61, 0x6d, 0x65, 0x31, 0xa4,
+            0x69, 0x63, 0x6f, 0x6e, 0xa5, 0x69, 0x63, 0x6f, 0x6e, 0x31, 0xa6, 0x63, 0x6f, 0x6e,
+            0x66, 0x69, 0x67, 0x83, 0xa4, 0x63, 0x6f, 0x6c, 0x73, 0x0a, 0xa4, 0x72, 0x6f, 0x77,
+            0x73, 0x0a, 0xa5, 0x6d, 0x69, 0x6e, 0x65, 0x73, 0x10,
+        ];
+        assert_init_room(Codec::MsgPack.decode(data));
+    }
+
+    #[test]
+    fn decode_msgpack_invalid() {
+        assert!(Codec::MsgPack.decode(&[0xc1]).is_err());
+    }
+
+    #[test]
+    fn encode_msgpack_join_success() {
+        let response = ResponseModel::JoinSuccess {
+            players: vec![Player {
+                id: "id1".to_string(),
+                name: "name1".to_string(),
+                icon: "icon1".to_string(),
+            }],
+            room_id: "66666".to_string(),
+        };
+        match Codec::MsgPack.encode(&response) {
+            Message::Binary(data) => {
+                let value: Value = rmp_serde::from_slice(&data).unwrap();
+                assert_eq!(value["type"], "JoinSuccess");
+                assert_eq!(value["room_id"], "66666");
+                assert_eq!(value["players"][0]["id"], "id1");
+            }
+            other => panic!("expected a binary frame, got {other:?}"),
+        }
+    }
+
+    #[test]
+    fn shard_in_range_and_stable() {
+        // shard 用掩码取下标，要求分片数是 2 的幂
+        assert!(ROOM_SHARDS.is_power_of_two());
+        let mut used = vec![false; ROOM_SHARDS];
+        for i in 0..1000 {
+            let room_id = format!("room{i}");
+            let index = shard(&room_id);
+            assert!(index < ROOM_SHARDS);
+            assert_eq!(index, shard(&room_id));
+            used[index] = true;
+        }
+        assert!(used.iter().filter(|&&u| u).count() > 1);
+    }
+
+    #[test]
+    fn encode_json_is_text_frame() {
+        let response = ResponseModel::InvalidRequest {
+            error: "oops".to_string(),
+        };
+        match Codec::Json.encode(&response) {
+            Message::Text(text) => {
+                let value: Value = serde_json::from_str(&text).unwrap();
+                assert_eq!(value["type"], "InvalidRequest");
+                assert_eq!(value["error"], "oops");
+            }
+            other => panic!("expected a text frame, got {other:?}"),
+        }
+    }
+}
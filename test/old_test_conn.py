@@ -1,45 +1,51 @@
 # 导入必要的库
 import argparse
 import asyncio
-import json
 import traceback
 from urllib.parse import quote_plus, urlencode
 
+import msgpack
 import websockets
 
+# 已建立的连接，所有客户端跑完后统一关闭
+_SOCKETS = []
+
+
+_INIT_MSG = msgpack.packb(
+    {
+        "type": "InitRoom",
+        "player": {
+            "id": "user_id1",
+            "name": "user_name1",
+            "icon": "user_icon1",
+        },
+        "config": {
+            "cols": 10,
+            "rows": 10,
+            "mines": 16,
+        },
+    }
+)
+
+_JOIN_MSG = msgpack.packb(
+    {
+        "type": "JoinRoom",
+        "room_id": "66666",
+        "player": {
+            "id": "user_id2",
+            "name": "user_name2",
+            "icon": "user_icon2",
+        },
+    }
+)
+
 
 async def send_create(websocket):
-    create_room_msg = json.dumps(
-        {
-            "type": "InitRoom",
-            "player": {
-                "user_id": "user_id1",
-                "user_name": "user_name1",
-                "user_icon": "user_icon1",
-            },
-            "config": {
-                "cols": 10,
-                "rows": 10,
-                "mines": 16,
-            },
-        }
-    )
-    await websocket.send(create_room_msg)
+    await websocket.send(_INIT_MSG)
 
 
 async def send_join(websocket):
-    create_room_msg = json.dumps(
-        {
-            "type": "JoinRoom",
-            "room_id": "66666",
-            "player": {
-                "user_id": "user_id2",
-                "user_name": "user_name2",
-                "user_icon": "user_icon2",
-            },
-        }
-    )
-    await websocket.send(create_room_msg)
+    await websocket.send(_JOIN_MSG)
 
 
 async def send(websocket):
@@ -47,20 +53,28 @@ async def send(websocket):
         await send_create(websocket)
     else:
         await send_join(websocket)
-    await asyncio.sleep(500)
 
 
 async def recv(websocket):
     try:
         while True:
-            response = await websocket.recv()
-            # room_id = json.loads(response).get("room_id")
+            response = msgpack.unpackb(await websocket.recv(), raw=False)
+            # room_id = response.get("room_id")
             print(f"创建房间响应: {response}")
 
+    except websockets.ConnectionClosed:
+        # 服务端关闭连接（如房间已满）只结束当前客户端，不影响其他客户端
+        print("### closed ###")
     except Exception as e:
         traceback.print_exc()
-        # await websocket.close()
-        exit()
+        # 抛出异常，由 TaskGroup 取消其他客户端
+        raise
+
+
+async def session(websocket):
+    # send 只发一条消息，直接在当前任务里执行，之后由同一个任务接收
+    await send(websocket)
+    await recv(websocket)
 
 
 async def ws_client():
@@ -77,19 +91,28 @@ async def ws_client():
         "rows": 10,
     }
 
-    async with websockets.connect(uri, subprotocols=["binary"], ping_interval=None, extra_headers=headers) as websocket:
-        task1 = asyncio.create_task(send(websocket))
-        task2 = asyncio.create_task(recv(websocket))
-        await asyncio.gather(task1, task2)
+    try:
+        for _ in range(args.clients):
+            websocket = await websockets.connect(
+                uri, subprotocols=["binary"], ping_interval=None, compression=None, extra_headers=headers
+            )
+            _SOCKETS.append(websocket)
+        async with asyncio.TaskGroup() as tg:
+            for websocket in _SOCKETS:
+                tg.create_task(session(websocket))
+    finally:
+        for websocket in _SOCKETS:
+            await websocket.close()
+        _SOCKETS.clear()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--flag", type=str, default="init")
+    parser.add_argument("--clients", type=int, default=1)
     args = parser.parse_args()
 
-    asyncio.get_event_loop().run_until_complete(ws_client())
-    asyncio.get_event_loop().run_forever()
+    asyncio.run(ws_client())
 
 """
 使用 python 的 websocket 库来替换上面的websockets 库，同时修改以下地方
@@ -1,14 +1,60 @@
 import argparse
+import asyncio
 import os
-from pathlib import Path
-from typing import List, Optional
+import resource
+import socket
+from contextlib import asynccontextmanager
+from typing import Optional
 
-import uvicorn
-from fastapi import APIRouter, Body, Depends, FastAPI, File, Query, UploadFile, WebSocket
-from fastapi.background import BackgroundTasks
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import FastAPI, Query, WebSocket
 
-app = FastAPI(title="ASR api", openapi_url=f"/openapi.json")
+# 每个 worker 进程同时服务的连接数上限；多 worker 时总上限为 workers * MAX_CONNECTIONS_PER_WORKER
+MAX_CONNECTIONS_PER_WORKER = 1000
+# 连接数已满时，新连接最多等待这么多秒，超时后以 1013 (Try Again Later) 拒绝
+ACQUIRE_TIMEOUT = 5
+
+
+class ConnectionLimiter:
+    """连接准入计数器，上限可以在运行时通过 resize 调整"""
+
+    def __init__(self, max_active: int):
+        self._cv = asyncio.Condition()
+        self._active = 0
+        self._max = max_active
+
+    async def acquire(self):
+        async with self._cv:
+            try:
+                await self._cv.wait_for(lambda: self._active < self._max)
+            except asyncio.CancelledError:
+                # 已被 notify 唤醒却在同一轮被取消（如 wait_for 超时）时，把唤醒转交给下一个等待者，
+                # 否则空出的名额没人拿到；CPython 3.13 的 Condition.wait 做了同样的处理
+                self._cv.notify(1)
+                raise
+            self._active += 1
+
+    async def release(self):
+        async with self._cv:
+            self._active -= 1
+            self._cv.notify(1)
+
+    async def resize(self, max_active: int):
+        # 只调整当前 worker 进程的上限，多 worker 时需要对每个 worker 分别调用
+        async with self._cv:
+            self._max = max_active
+            self._cv.notify_all()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 服务只在启动时创建一次，所有连接共享。
+    # 这里假设 MPMInferService.run() 不在实例上保存连接相关的状态，否则不能共享同一个实例
+    app.state.mpm_infer_service = MPMInferService()
+    app.state.limiter = ConnectionLimiter(MAX_CONNECTIONS_PER_WORKER)
+    yield
+
+
+app = FastAPI(title="ASR api", openapi_url=f"/openapi.json", lifespan=lifespan)
 
 
 @app.websocket("/server")
@@ -16,16 +62,97 @@ async def server(
     websocket: WebSocket,
     client_id: Optional[str] = Query(None),
 ):
-    mpm_infer_service = MPMInferService()
-    await mpm_infer_service.run(websocket, client_id)
+    limiter = websocket.app.state.limiter
+    try:
+        await asyncio.wait_for(limiter.acquire(), ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        # 握手前 close 会被 uvicorn 转成 HTTP 403，先 accept 才能把 1013 关闭码发给客户端
+        await websocket.accept()
+        await websocket.close(code=1013)
+        return
+    try:
+        await websocket.app.state.mpm_infer_service.run(websocket, client_id)
+    finally:
+        await limiter.release()
+
+
+def raise_nofile_limit(target: int = 65535):
+    # 每个 WebSocket 连接占用一个文件描述符，尽量把软限制提高到 target
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY:
+        target = min(target, hard)
+    if soft < target:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    # 每个 worker 各自绑定同一端口（SO_REUSEPORT），由内核在 worker 之间分发新连接；
+    # 在监听 socket 上设置选项，accept 出来的连接会继承 SO_KEEPALIVE
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.bind((host, port))
+    return sock
+
+
+def run_worker(host: str, port: int, certfile: str, keyfile: str):
+    # 只在启动服务时需要，导入 app 模块时不加载
+    import uvicorn
+
+    config = uvicorn.Config(
+        app,
+        host=host,
+        port=port,
+        ssl_certfile=certfile,
+        ssl_keyfile=keyfile,
+        loop="uvloop",
+        http="httptools",
+        ws="websockets",
+        ws_max_size=2**22,
+        ws_max_queue=1024,
+        ws_ping_interval=20,
+        ws_ping_timeout=20,
+        ws_per_message_deflate=True,
+    )
+    try:
+        uvicorn.Server(config).run(sockets=[bind_socket(host, port)])
+    except KeyboardInterrupt:
+        # uvicorn 优雅退出后会重新抛出 SIGINT，这里不再打印堆栈
+        pass
 
 
 if __name__ == "__main__":
+    import multiprocessing
+    import signal
     from pathlib import Path
 
     warkspace = Path(__file__).parent.parent
     parser = argparse.ArgumentParser()
     parser.add_argument("--certfile", type=str, default=f"{warkspace}/ssl_key/server.crt", required=False)
     parser.add_argument("--keyfile", type=str, default=f"{warkspace}/ssl_key/server.key", required=False)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), required=False)
     args = parser.parse_args()
-    uvicorn.run(app, host="0.0.0.0", port=15439, ssl_certfile=args.certfile, ssl_keyfile=args.keyfile)
+
+    raise_nofile_limit()
+    worker_args = ("0.0.0.0", 15439, args.certfile, args.keyfile)
+    if args.workers > 1:
+        # 每个 worker 是独立进程，各自持有 MPMInferService 和 ConnectionLimiter
+        ctx = multiprocessing.get_context("spawn")
+        workers = [ctx.Process(target=run_worker, args=worker_args) for _ in range(args.workers)]
+        for worker in workers:
+            worker.start()
+
+        def stop_workers(signum, frame):
+            # 把退出信号转发给 worker，由 uvicorn 各自优雅退出
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+
+        signal.signal(signal.SIGINT, stop_workers)
+        signal.signal(signal.SIGTERM, stop_workers)
+        for worker in workers:
+            worker.join()
+    else:
+        run_worker(*worker_args)
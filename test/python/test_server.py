@@ -0,0 +1,47 @@
+import asyncio
+
+from server import ConnectionLimiter
+
+
+def test_cancelled_waiter_passes_wakeup_on():
+    async def scenario():
+        limiter = ConnectionLimiter(1)
+        await limiter.acquire()
+        first = asyncio.create_task(limiter.acquire())
+        second = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        # release 唤醒 first，first 在被调度前就被取消，名额应该交给 second
+        await limiter.release()
+        first.cancel()
+        await asyncio.wait_for(second, 1)
+        assert limiter._active == 1
+
+    asyncio.run(scenario())
+
+
+def test_acquire_times_out_when_full():
+    async def scenario():
+        limiter = ConnectionLimiter(1)
+        await limiter.acquire()
+        try:
+            await asyncio.wait_for(limiter.acquire(), 0.05)
+        except asyncio.TimeoutError:
+            pass
+        else:
+            raise AssertionError("acquire should time out while the limiter is full")
+        assert limiter._active == 1
+
+    asyncio.run(scenario())
+
+
+def test_resize_wakes_waiters():
+    async def scenario():
+        limiter = ConnectionLimiter(1)
+        await limiter.acquire()
+        waiters = [asyncio.create_task(limiter.acquire()) for _ in range(2)]
+        await asyncio.sleep(0)
+        await limiter.resize(3)
+        await asyncio.wait_for(asyncio.gather(*waiters), 1)
+        assert limiter._active == 3
+
+    asyncio.run(scenario())
@@ -1,81 +1,94 @@
 import argparse
-import json
-import threading
+import asyncio
+from typing import Final
 
-import websocket
+import aiohttp
+import orjson
+import simdjson
 
+# 超过该长度的帧（如大面积翻开后的 GameOpRes）交给 simdjson 解析
+_LARGE_FRAME = 2048
+# 复用同一个 parser，避免每帧重新分配缓冲区
+_PARSER = simdjson.Parser()
 
-def on_message(ws, message):
+# 控制消息是常量，导入时编码一次；服务端把二进制帧当作 MessagePack，所以这里按文本帧发送
+_INIT_MSG: Final[str] = orjson.dumps(
+    {
+        "type": "InitRoom",
+        "player": {
+            "id": "id",
+            "name": "name",
+            "icon": "icon",  # 玩家头像的base64编码
+        },
+        "config": {
+            "cols": 10,
+            "rows": 10,
+            "mines": 16,
+        },
+    }
+).decode()
+
+_JOIN_MSG: Final[str] = orjson.dumps(
+    {
+        "type": "JoinRoom",
+        "room_id": "66666",
+        "player": {
+            "id": "user_id2",
+            "name": "user_name2",
+            "icon": "user_icon2",
+        },
+    }
+).decode()
+
+
+def decode_frame(data):
+    if len(data) > _LARGE_FRAME:
+        return _PARSER.parse(data, recursive=True)
+    return orjson.loads(data)
+
+
+def on_message(message):
     print(f"Received message: {message}")
     try:
-        response = json.loads(message)
+        response = decode_frame(message)
         # Handle different types of messages based on the `type` field
         if response["type"] == "InitRoom":
             print(f"Room initialized with ID: {response['room_id']}")
         elif response["type"] == "JoinRoom":
             print("Joined room.")
         # Add handling for other message types as necessary
-    except json.JSONDecodeError:
+    except ValueError:
         print("Error decoding JSON from message")
 
 
-def on_error(ws, error):
-    print(f"Error: {error}")
-
-
-def on_close(ws, close_status_code, close_msg):
+async def run(session, url, flag):
+    async with session.ws_connect(url) as ws:
+        await ws.send_str(_INIT_MSG if flag == "init" else _JOIN_MSG)
+        async for msg in ws:
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                on_message(msg.data)
+            elif msg.type == aiohttp.WSMsgType.ERROR:
+                print(f"Error: {ws.exception()}")
     print("### closed ###")
 
 
-def on_open(ws):
-    def run(*args):
-        if args[0] == "init":
-            create_room_msg = json.dumps(
-                {
-                    "type": "InitRoom",
-                    "player": {
-                        "id": "id",
-                        "name": "name",
-                        "icon": "icon",  # 玩家头像的base64编码
-                    },
-                    "config": {
-                        "cols": 10,
-                        "rows": 10,
-                        "mines": 16,
-                    },
-                }
-            )
-            ws.send(create_room_msg)
-        else:
-            join_room_msg = json.dumps(
-                {
-                    "type": "JoinRoom",
-                    "room_id": "66666",
-                    "player": {
-                        "user_id": "user_id2",
-                        "user_name": "user_name2",
-                        "user_icon": "user_icon2",
-                    },
-                }
-            )
-            ws.send(join_room_msg)
-
-        # Add any additional operations here if needed
-
-    thread = threading.Thread(target=run, args=(args.flag,))
-    thread.start()
+async def main(url, flag, clients):
+    # 所有客户端共用一个事件循环和 ClientSession，不再为每个连接创建线程
+    async with aiohttp.ClientSession() as session:
+        async with asyncio.TaskGroup() as tg:
+            for _ in range(clients):
+                tg.create_task(run(session, url, flag))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--flag", type=str, help="init to create room, any other value to join room", default="init")
+    parser.add_argument("--clients", type=int, help="number of concurrent clients", default=1)
     args = parser.parse_args()
 
-    websocket.enableTrace(True)
     url = "ws://abracadabra.v2.idcfengye.com/ws"
     url = "wss://lvpy.chailab.cn:33000/ws/mpm/ws"
     url = "ws://10.4.208.55:30081"
     url = "ws://10.4.208.55:8003/mpm"
     url = "wss://lvpy.chailab.cn:33000/mpm"
-    ws = websocket.WebSocketApp(url, on_open=on_open, on_message=on_message, on_error=on_error, on_close=on_close)
-    ws.run_forever()
+    asyncio.run(main(url, args.flag, args.clients))